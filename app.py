@@ -3,13 +3,13 @@ import re
 import json
 import uuid
 import pathlib
-import random
 from typing import List, Tuple
 import requests.exceptions
 
 import streamlit as st
 from dotenv import load_dotenv
 from google import genai
+from google.genai import types
 
 # --- Local Imports ---
 from src.session import (
@@ -17,7 +17,9 @@ from src.session import (
     active_history,
     append_msg,
     create_new_chat,
-    save_convos,
+    schedule_save,
+    flush_convos,
+    mark_dirty,
     find_empty_chat
 )
 from src.guards import guardrails_or_offtopic
@@ -26,7 +28,7 @@ from src.llm import (
     _maybe_update_title_after_first_turn,
     mark_offtopic
 )
-from src.firebase_auth import get_auth, delete_conversation_from_firestore
+from src.firebase_auth import get_auth
 from src.login import show_login_page
 from src.game import handle_password_game
 
@@ -47,22 +49,41 @@ SYSTEM_INSTRUCTION = (
     "but refuse to teach actual hacking techniques, exploit code, or illegal activities. "
     "Use clear, short paragraphs and end with 1–2 actionable tips."
 )
-client = genai.Client(api_key=GEMINI_API_KEY) if GEMINI_API_KEY else None
+# The system instruction is sent in its own config field rather than pasted into
+# the transcript, so the conversation part of each request holds only the chat.
+GENERATION_CONFIG = types.GenerateContentConfig(system_instruction=SYSTEM_INSTRUCTION)
+
+@st.cache_resource
+def get_gemini_client():
+    """
+    Returns one shared Gemini client per server process (None without an API key).
+    """
+    return genai.Client(api_key=GEMINI_API_KEY) if GEMINI_API_KEY else None
+
+client = get_gemini_client()
+
+# ---------------- Game / Quiz Trigger Keywords ----------------
+# Synonyms for "improve": catches "make it better", "more secure", "stronger", "strengthen", etc.
+IMPROVE_KEYWORDS = ("improve", "better", "secure", "strong", "safe", "strengthen")
+PHISHING_TEST_KEYWORDS = ("test", "quiz", "check", "practice", "game", "spot", "identify")
 
 # ---------------- Asset Injection ----------------
-def inject_file(file_path: str):
-    p = pathlib.Path(file_path)
-    with p.open("r", encoding="utf-8") as f:
-        content = f.read()
-    st.markdown(f"<style>{content}</style>", unsafe_allow_html=True)
+@st.cache_data(show_spinner=False)
+def _read_css(file_path: str) -> str:
+    # Read once per path per server process; reruns are served from the cache
+    return pathlib.Path(file_path).read_text(encoding="utf-8")
 
-def inject_theme(mode: str = "dark"):
-    inject_file(f"assets/{mode}_theme.css")
+def inject_css_bundle(paths: List[str]):
+    # One <style> tag (one websocket message) for all stylesheets of this run
+    css = "\n".join(_read_css(p) for p in paths)
+    st.markdown(f"<style>{css}</style>", unsafe_allow_html=True)
 
 # Inject all CSS globally on every run
 current_theme = st.session_state.get("ui_theme", "dark")
-inject_theme(current_theme)
-inject_file("assets/style.css") # Inject general styles first
+css_paths = [f"assets/{current_theme}_theme.css", "assets/style.css"]
+if not st.session_state.get('logged_in'):
+    css_paths.append("assets/login_page_header_styles.css") # Login page specific styles
+inject_css_bundle(css_paths)
 
 # ---------------- Reusable UI Components ----------------
 def show_theme_selector():
@@ -79,7 +100,7 @@ def show_theme_selector():
         st.rerun()
 
 # ---------------- Main Chatbot Application UI ----------------
-def show_chatbot_ui():
+def _render_sidebar():
     # --- Sidebar / Navigation UI ---
     with st.sidebar:
         st.image("logo.png", width=140)
@@ -113,7 +134,7 @@ def show_chatbot_ui():
         else:
             new_id = create_new_chat(convos)
             st.session_state.active_id = new_id
-            save_convos()
+            schedule_save()
             st.rerun()
 
         st.divider()
@@ -131,17 +152,16 @@ def show_chatbot_ui():
             with col_yes:
                 if st.button("Yes", type="primary", use_container_width=True):
                     # --- DELETION LOGIC ---
-                    uid = st.session_state.user_info.get("localId")
-                    if uid:
-                        delete_conversation_from_firestore(uid, active_id)
-                    
+                    # A dirty id that is no longer in convos is deleted by the (queued) save,
+                    # so it cannot race with a pending write of the same chat.
                     convos.pop(active_id, None)
+                    mark_dirty(active_id)
                     st.session_state.active_id = next(iter(convos), None)
                     if not st.session_state.active_id:
                         new_id = create_new_chat(convos)
                         st.session_state.active_id = new_id
                     
-                    save_convos()
+                    schedule_save()
                     st.session_state.confirming_delete = False 
                     st.toast("🗑️ Chat deleted", icon="✅")
                     st.rerun()
@@ -161,7 +181,7 @@ def show_chatbot_ui():
                 else:
                     new_id = create_new_chat(convos)
                     st.session_state.active_id = new_id
-                    save_convos()
+                    schedule_save()
                     st.toast("New chat created", icon="✨")
                 st.rerun()
             
@@ -181,7 +201,8 @@ def show_chatbot_ui():
             if c1.button("Save", use_container_width=True):
                 convos[active_id]["name"] = new_name.strip() or convos[active_id]["name"]
                 st.session_state.renaming = False
-                save_convos()
+                mark_dirty(active_id)
+                schedule_save()
                 st.rerun()
             if c2.button("Cancel", use_container_width=True):
                 st.session_state.renaming = False
@@ -200,6 +221,8 @@ def show_chatbot_ui():
         
         with col3:
             if st.button("Sign Out", use_container_width=True):
+                # Write out debounced changes while we still know who the user is
+                flush_convos()
                 st.session_state.logged_in = False
                 st.session_state.pop('user_info', None)
                 st.session_state.pop('login_password_prev', None)
@@ -208,10 +231,17 @@ def show_chatbot_ui():
                 # Clear conversation state
                 st.session_state.pop('convos', None)
                 st.session_state.pop('active_id', None) 
+                st.session_state.pop('dirty_convos', None)
+                st.session_state.pop('save_state', None)
+                st.session_state.pop('_saver', None)
                 
                 st.rerun()
 
+@st.fragment
+def _render_chat():
     # --- Main Chat Area ---
+    # Runs as a fragment: submitting a message only reruns this block,
+    # not the sidebar or the CSS injection at the top of the script.
     st.title("🛡️ CyCore")
     st.caption("Ask about any cybersecurity topic you wish to learn about.")
 
@@ -220,9 +250,10 @@ def show_chatbot_ui():
             st.markdown(msg)
 
     if user_msg := st.chat_input("Message CyCore…"):
+        msg_lower = user_msg.lower()
         history = active_history()
         if (
-            user_msg.lower() == "yes"
+            msg_lower == "yes"
             and len(history) > 0
             and history[-1][0] == "assistant"
             and "would you like to play a game" in history[-1][1].lower()
@@ -235,10 +266,10 @@ def show_chatbot_ui():
             handle_password_game(user_msg)
             st.rerun()
 
-        if "password" in user_msg.lower():
+        if "password" in msg_lower:
             st.session_state.password_question_count += 1
         
-        if "phishing" in user_msg.lower():
+        if "phishing" in msg_lower:
             st.session_state.phishing_question_count += 1
 
         if not st.session_state.get("in_password_game"):
@@ -254,19 +285,18 @@ def show_chatbot_ui():
                 st.markdown(user_msg)
             
             with st.chat_message("assistant", avatar="🛡️"):
-                placeholder, collected = st.empty(), ""
                 try:
                     if not client:
                         raise ValueError("Gemini API client not initialized.")
-                    prompt = build_prompt(SYSTEM_INSTRUCTION, user_msg, active_history())
-                    stream = client.models.generate_content_stream(model=MODEL, contents=prompt)
-                    for ev in stream:
-                        if hasattr(ev, "text") and ev.text:
-                            collected += ev.text
-                            placeholder.markdown(collected)
+                    prompt = build_prompt(user_msg, active_history())
+                    stream = client.models.generate_content_stream(
+                        model=MODEL, contents=prompt, config=GENERATION_CONFIG
+                    )
+                    # write_stream only ships the new chunks to the browser, not the whole text per token
+                    collected = st.write_stream(ev.text for ev in stream if getattr(ev, "text", None))
                 except Exception as e:
                     collected = f"⚠️ An error occurred: {e}"
-                    placeholder.markdown(collected)
+                    st.markdown(collected)
 
             # ---------------------------------------------------------
             # Logic to Trigger the Password Quiz Game
@@ -278,17 +308,14 @@ def show_chatbot_ui():
             trigger_game = False
             
             # Condition A: Explicit request (Checking synonyms for "improve")
-            # This catches: "make it better", "more secure", "stronger", "strengthen", etc.
-            improve_keywords = ["improve", "better", "secure", "strong", "safe", "strengthen"]
-            
-            if "password" in user_msg.lower() and any(k in user_msg.lower() for k in improve_keywords):
+            if "password" in msg_lower and any(k in msg_lower for k in IMPROVE_KEYWORDS):
                 trigger_game = True
                 
             # Condition B: Randomly trigger after the 2nd OR 3rd question
             # - If count is >= 3, it triggers automatically (guaranteed).
             # - If count is 2, we flip a coin (50% chance) to trigger early.
             elif st.session_state.password_question_count >= 3 or \
-                 (st.session_state.password_question_count == 2 and random.choice([True, False])):
+                 (st.session_state.password_question_count == 2 and st.session_state.rng.getrandbits(1)):
                 trigger_game = True
 
             # 3. If Triggered, Send the Prompt as a NEW Message
@@ -308,16 +335,13 @@ def show_chatbot_ui():
             # ---------------------------------------------------------
             trigger_phishing = False
             
-            # 1. Keywords for explicit request
-            phishing_test_keywords = ["test", "quiz", "check", "practice", "game", "spot", "identify"]
-            
-            # Condition A: Explicit request
-            if "phishing" in user_msg.lower() and any(k in user_msg.lower() for k in phishing_test_keywords):
+            # Condition A: Explicit request (PHISHING_TEST_KEYWORDS)
+            if "phishing" in msg_lower and any(k in msg_lower for k in PHISHING_TEST_KEYWORDS):
                 trigger_phishing = True
                 
             # Condition B: Randomly trigger after the 2nd OR 3rd question about phishing
             elif st.session_state.phishing_question_count >= 3 or \
-                 (st.session_state.phishing_question_count == 2 and random.choice([True, False])):
+                 (st.session_state.phishing_question_count == 2 and st.session_state.rng.getrandbits(1)):
                 trigger_phishing = True
             
             if trigger_phishing:
@@ -334,12 +358,16 @@ def show_chatbot_ui():
             
             # ---------------------------------------------------------
 
+            # A new title triggers a full rerun (sidebar list); otherwise only the chat reruns
             _maybe_update_title_after_first_turn(client, MODEL)
-            st.rerun()
+            st.rerun(scope="fragment")
+
+def show_chatbot_ui():
+    _render_sidebar()
+    _render_chat()
 
 # ---------------- App Entry Point ----------------
 if st.session_state.get('logged_in'):
     show_chatbot_ui()
 else:
-    inject_file("assets/login_page_header_styles.css") # Inject login page specific styles
     show_login_page(auth_handler, show_theme_selector)
@@ -1,5 +1,5 @@
 import streamlit as st
-from src.firebase_auth import get_user_data, load_conversations_from_firestore
+from src.firebase_auth import get_user_data, load_conversations_cached, new_save_state, wait_for_saves
 from src.session import create_new_chat
 
 def load_user_data_from_firestore():
@@ -15,9 +15,12 @@ def load_user_data_from_firestore():
     if user_data:
         st.session_state.user_info.update(user_data) 
 
-    # 2. Load conversations
-    convos = load_conversations_from_firestore(uid)
+    # 2. Load conversations, after any save still queued from a previous session
+    wait_for_saves(uid)
+    convos, saved = load_conversations_cached(uid)
     st.session_state.convos = convos
+    st.session_state.dirty_convos = set()
+    st.session_state.save_state = new_save_state(saved)
     
     # 3. Set active chat
     if convos:
@@ -2,10 +2,29 @@ import streamlit as st
 import pyrebase
 import firebase_admin
 from firebase_admin import credentials, firestore
+import os
+import glob
 import json
-from typing import Dict, Any, List, Tuple
+import hashlib
+import secrets
+import tempfile
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Any, Iterable, List, Tuple
 import base64
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, InvalidToken
+
+# --- Background writer for conversation saves ---
+# Writes for the same uid go through one queue and are drained by a single
+# worker at a time, so they reach Firestore in the order they were submitted.
+_SAVE_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="firestore-save")
+_SAVE_QUEUES: Dict[str, queue.Queue] = {}
+_SAVE_QUEUES_LOCK = threading.Lock()
+
+# Firestore rejects batches with more than 500 writes
+_BATCH_LIMIT = 500
 
 # --- Pyrebase (for Firebase Authentication) ---
 @st.cache_resource
@@ -41,6 +60,44 @@ def get_auth():
     return app.auth() if app else None
 
 # --- Firebase Admin SDK (for Firestore Database) ---
+def _service_account_file(base64_string: str) -> str | None:
+    """
+    Returns the path of the decoded service-account JSON, written once to a private
+    (0600) file on tmpfs so later processes skip the base64 decode (the JSON itself
+    is still parsed by credentials.Certificate).
+    The file name carries a digest of the secret, so a rotated key gets a new file
+    and the files of earlier keys are removed.
+    Returns None without tmpfs: the decoded private key is never written to disk.
+    """
+    cache_dir = "/dev/shm"
+    if not os.path.isdir(cache_dir):
+        return None
+    digest = hashlib.sha256(base64_string.encode()).hexdigest()[:16]
+    path = os.path.join(cache_dir, f"cycore-sa-{digest}.json")
+    if not os.path.exists(path):
+        # Don't leave the private keys of rotated-out credentials lying around.
+        # The current key's file is kept: another worker may have just written it.
+        for stale_path in glob.glob(os.path.join(cache_dir, "cycore-sa-*.json")):
+            if stale_path == path:
+                continue
+            try:
+                os.remove(stale_path)
+            except OSError:
+                pass
+        # mkstemp creates the file with 0600; the rename makes it appear atomically
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix="cycore-sa-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(base64.b64decode(base64_string))
+            os.replace(tmp_path, path)
+        except Exception:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+    return path
+
 @st.cache_resource
 def initialize_firebase_admin():
     """
@@ -55,12 +112,20 @@ def initialize_firebase_admin():
             # Access the nested key to get the string value
             base64_string = st.secrets.firebase_service_account_base64.firebase_service_account_base64
             
-            # Decode the base64 string into bytes and load as a dictionary
-            json_bytes = base64.b64decode(base64_string)
-            cred_dict = json.loads(json_bytes.decode('utf-8'))
+            cred = None
+            try:
+                sa_path = _service_account_file(base64_string)
+                if sa_path is not None:
+                    cred = credentials.Certificate(sa_path)
+            except OSError as e:
+                # tmpfs not writable, or the file was removed before it could be read
+                print(f"Service account file unavailable, decoding in memory: {e}")
+            if cred is None:
+                # Decode in memory into a dictionary
+                json_bytes = base64.b64decode(base64_string)
+                cred = credentials.Certificate(json.loads(json_bytes.decode('utf-8')))
 
-            # Initialize the app using the dictionary
-            cred = credentials.Certificate(cred_dict)
+            # Initialize the app using the credential file (or dictionary)
             firebase_admin.initialize_app(cred)
             
         except Exception as e:
@@ -95,6 +160,23 @@ def get_encryption_cipher():
         st.error(f"Failed to initialize encryption cipher: {e}")
         return None
 
+# Hot-path handles, bound once per process instead of going through the
+# st.cache_resource lookup on every load/save.
+_DB = None
+_CIPHER = None
+
+def _get_db():
+    global _DB
+    if _DB is None:
+        _DB = get_firestore_db()
+    return _DB
+
+def _get_cipher():
+    global _CIPHER
+    if _CIPHER is None:
+        _CIPHER = get_encryption_cipher()
+    return _CIPHER
+
 # --- Firestore User and Conversation Helper Functions ---
 
 def create_user_in_db(uid: str, email: str, username: str):
@@ -128,108 +210,317 @@ def get_user_data(uid: str) -> Dict[str, Any] | None:
             st.error(f"Failed to retrieve user from Firestore: {e}")
     return None
 
-def load_conversations_from_firestore(uid: str) -> Dict[str, Any]:
+def _conversations_version_ref(db, uid: str):
+    """
+    Returns the reference to the small 'meta/version' doc that tracks conversation writes.
+    """
+    return db.collection("users").document(uid).collection("meta").document("version")
+
+def get_conversations_version(uid: str) -> int:
+    """
+    Reads the user's conversation version counter (0 if it has never been written).
+    Raises if it cannot be read: an unknown version must not pick a cached load.
+    """
+    db = _get_db()
+    if not db:
+        raise RuntimeError("Firestore is not configured")
+    version_doc = _conversations_version_ref(db, uid).get()
+    if version_doc.exists:
+        return (version_doc.to_dict() or {}).get("conversations_version", 0)
+    return 0
+
+@st.cache_data(ttl=900, show_spinner=False)
+def _load_conversations_cached(uid: str, version: int) -> Tuple[Dict[str, Any], Dict[str, Tuple[int, bytes | None]]]:
+    """
+    Cached wrapper around 'load_conversations_from_firestore'.
+    The 'version' argument is only part of the cache key: any write bumps it.
+    Failures raise, so st.cache_data never stores an empty result for them.
+    """
+    return load_conversations_from_firestore(uid)
+
+def load_conversations_cached(uid: str) -> Tuple[Dict[str, Any], Dict[str, Tuple[int, bytes | None]]]:
+    """
+    Loads the user's conversations, reusing the decrypted result until they change.
+    Returns (convos, saved) like 'load_conversations_from_firestore'; if the version
+    or the conversations cannot be read, reports the error and returns empty results.
+    """
+    try:
+        return _load_conversations_cached(uid, get_conversations_version(uid))
+    except Exception as e:
+        st.error(f"Failed to load conversations: {e}")
+        return {}, {}
+
+def new_save_state(saved: Dict[str, Tuple[int, bytes | None]] | None = None) -> Dict[str, Any]:
+    """
+    Per-session record of what this session has stored for each conversation.
+    'saved' maps conv_id -> (number of messages stored, metadata digest); history
+    is append-only, so a save only writes the messages past that count, and skips
+    the metadata when its digest did not change. 'writer' is a random id that
+    keeps this session's message docs apart from those of other sessions (e.g. a
+    second tab) of the same user.
+    """
+    return {"writer": secrets.token_hex(4), "saved": dict(saved or {})}
+
+def _conversation_ref(db, uid: str, conv_id: str):
+    return db.collection("users").document(uid).collection("conversations").document(conv_id)
+
+def _commit_writes(db, writes: List[Tuple[Any, Dict[str, Any] | None]]):
+    """
+    Commits (doc_ref, data) pairs as Firestore batches; data=None deletes the doc.
+    """
+    for start in range(0, len(writes), _BATCH_LIMIT):
+        batch = db.batch()
+        for doc_ref, data in writes[start:start + _BATCH_LIMIT]:
+            if data is None:
+                batch.delete(doc_ref)
+            else:
+                batch.set(doc_ref, data, merge=True)
+        batch.commit()
+
+def _backfill_created_at(db, uid: str, col_ref):
+    """
+    One-off migration: conversations saved before 'created_at' existed are invisible
+    to the ordered query, so stamp them with their document creation time.
+    """
+    version_ref = _conversations_version_ref(db, uid)
+    version_doc = version_ref.get()
+    if version_doc.exists and (version_doc.to_dict() or {}).get("created_at_backfilled"):
+        return
+
+    _commit_writes(db, [
+        (doc.reference, {"created_at": doc.create_time.timestamp()})
+        for doc in col_ref.select(["created_at"]).stream()
+        if _get_field(doc, "created_at") is None
+    ])
+    version_ref.set({"created_at_backfilled": True}, merge=True)
+
+def _get_field(doc, field: str) -> Any:
+    """
+    Reads one field of a DocumentSnapshot without building the full to_dict() copy.
+    Returns None if the field is missing.
+    """
+    try:
+        return doc.get(field)
+    except KeyError:
+        return None
+
+def _decrypt_json(cipher, encrypted_data: bytes) -> Any:
+    return json.loads(cipher.decrypt(encrypted_data).decode())
+
+def load_conversations_from_firestore(uid: str) -> Tuple[Dict[str, Any], Dict[str, Tuple[int, bytes | None]]]:
     """
     Loads all conversation documents from the user's 'conversations' subcollection,
-    decrypts them, and sorts them by creation time (Oldest First).
+    decrypts them, and returns them ordered by creation time (Oldest First).
+    The ordering is done by Firestore on the 'created_at' field.
+
+    Each conversation doc holds the encrypted metadata (name, ...); its messages
+    live in a 'messages' subcollection, one encrypted doc per turn. Chats saved
+    before that split still carry the whole history in the conversation doc.
+
+    Returns (convos, saved), where 'saved' is what is already stored per chat,
+    as kept in 'new_save_state'. Raises if Firestore cannot be read.
     """
-    db = get_firestore_db()
-    cipher = get_encryption_cipher()
+    db = _get_db()
+    cipher = _get_cipher()
     if not db or not cipher:
-        return {}
+        raise RuntimeError("Firestore or the encryption cipher is not configured")
 
-    # We use a list to store data temporarily so we can sort it
-    loaded_chats = [] 
+    convos = {}
+    saved = {}
 
-    try:
-        col_ref = db.collection("users").document(uid).collection("conversations")
-        docs = col_ref.stream()
-        
-        for doc in docs:
-            chat_id = doc.id
-            data = doc.to_dict()
+    col_ref = db.collection("users").document(uid).collection("conversations")
+    _backfill_created_at(db, uid, col_ref)
+
+    # Only ship the fields we need, already sorted (Oldest First)
+    docs = col_ref.order_by("created_at").select(["encrypted_data", "created_at", "msg_count"]).stream()
+    
+    for doc in docs:
+        chat_id = doc.id
+
+        # Left-over empty chat: nothing worth decrypting
+        if _get_field(doc, 'msg_count') == 0:
+            continue
+
+        encrypted_data = _get_field(doc, 'encrypted_data')
+        if encrypted_data is None:
+            continue
+
+        try:
+            clean_session = _decrypt_json(cipher, encrypted_data)
             
-            if 'encrypted_data' in data:
-                try:
-                    # Decrypt and parse JSON
-                    encrypted_data = data['encrypted_data']
-                    decrypted_bytes = cipher.decrypt(encrypted_data)
-                    decrypted_string = decrypted_bytes.decode()
-                    clean_session = json.loads(decrypted_string)
-                    
-                    # Convert history from list of dictionaries back to list of tuples
-                    if 'history' in clean_session and isinstance(clean_session['history'], list):
-                        clean_session['history'] = [
-                            (msg['role'], msg['content']) for msg in clean_session['history']
-                        ]
-                    
-                    # Append tuple: (creation_time, chat_id, session_data)
-                    loaded_chats.append((doc.create_time, chat_id, clean_session))
-                
-                except Exception as e:
-                    print(f"Skipping corrupt chat {chat_id}: {e}")
-                    continue
+            if isinstance(clean_session.get('history'), list):
+                # Legacy chat: history is embedded, no message docs written yet
+                history = clean_session['history']
+                saved[chat_id] = (0, None)
+            else:
+                msg_docs = doc.reference.collection("messages").order_by("seq").select(["encrypted_data"]).stream()
+                history = [_decrypt_json(cipher, m.get('encrypted_data')) for m in msg_docs]
+                # The digest lets the next save skip the metadata rewrite if nothing changed
+                saved[chat_id] = (len(history), hashlib.blake2b(
+                    json.dumps(clean_session).encode(), digest_size=16
+                ).digest())
+
+            # Convert history from list of dictionaries back to list of tuples
+            clean_session['history'] = [(msg['role'], msg['content']) for msg in history]
+
+            # Older chats only carry the (backfilled) plaintext timestamp
+            clean_session.setdefault('created_at', _get_field(doc, 'created_at'))
+            convos[chat_id] = clean_session
         
-        # --- CHANGED: Removed 'reverse=True' to default to Ascending order (Oldest First) ---
-        loaded_chats.sort(key=lambda x: x[0]) 
+        except (InvalidToken, ValueError, KeyError, TypeError) as e:
+            # Only undecryptable/malformed data is skipped; Firestore errors propagate
+            print(f"Skipping corrupt chat {chat_id}: {e}")
+            saved.pop(chat_id, None)
+            continue
+        
+    return convos, saved
 
-        # Reconstruct the dictionary in the sorted order
-        convos = {chat_id: session for (_, chat_id, session) in loaded_chats}
-            
-        return convos
-    except Exception as e:
-        st.error(f"Failed to load conversations: {e}")
-        return {}
+def _conversation_delete_writes(db, uid: str, conv_id: str) -> List[Tuple[Any, None]]:
+    """
+    Delete writes for a conversation doc together with its 'messages' subcollection
+    (Firestore does not cascade deletes to subcollections).
+    """
+    conv_ref = _conversation_ref(db, uid, conv_id)
+    writes = [(msg_ref, None) for msg_ref in conv_ref.collection("messages").list_documents()]
+    writes.append((conv_ref, None))
+    return writes
 
-def save_conversations_to_firestore(uid: str, convos: Dict[str, Any]):
+def save_conversations_to_firestore(uid: str, convos: Dict[str, Any], dirty_ids: Iterable[str] | None = None,
+                                    save_state: Dict[str, Any] | None = None):
     """
     Saves each conversation in the 'convos' dictionary as a separate document
     in the 'conversations' subcollection in Firestore, with encryption.
     Only saves conversations that have a history.
+    If 'dirty_ids' is given, only those conversations are written (ids missing
+    from 'convos' are deleted); otherwise every conversation is written.
+
+    Messages are stored one per doc under 'messages' and only those appended
+    since the last save of this session ('save_state', see 'new_save_state')
+    are encrypted and written; the conversation doc itself only holds the
+    metadata and is rewritten when that changes.
+    All writes of one call, including the version bump, go out as one batch.
+    Raises if the write fails; the save state is only updated after a successful commit.
     """
-    db = get_firestore_db()
-    cipher = get_encryption_cipher()
+    db = _get_db()
+    cipher = _get_cipher()
     if not db or not cipher:
         return
-        
-    try:
-        for conv_id, session_data in convos.items():
-            # Only save if the conversation has history
-            if session_data.get("history"):
-                doc_ref = db.collection("users").document(uid).collection("conversations").document(conv_id)
-                
-                # Prepare data for saving
-                clean_session = dict(session_data)
-                if 'history' in clean_session and isinstance(clean_session['history'], list):
-                    # Convert list of (role, msg) tuples to a list of dictionaries
-                    clean_session['history'] = [
-                        {'role': role, 'content': msg} for role, msg in clean_session['history']
-                    ]
-                
-                # Convert to JSON string and encrypt
-                json_string = json.dumps(clean_session)
-                encrypted_data = cipher.encrypt(json_string.encode())
-                
-                # Save encrypted data (as bytes) to Firestore
-                doc_ref.set({'encrypted_data': encrypted_data}, merge=True)
-            else:
-                # If a chat becomes empty, delete it from Firestore
-                doc_ref = db.collection("users").document(uid).collection("conversations").document(conv_id)
-                doc_ref.delete()
-                
-    except Exception as e:
-        st.error(f"Failed to save conversations: {e}")
+    if save_state is None:
+        save_state = new_save_state()
+    saved = save_state["saved"]
+    writer = save_state["writer"]
 
-def delete_conversation_from_firestore(uid: str, chat_id: str):
+    writes = []
+    written = {}  # conv_id -> (message count, metadata digest), recorded after the commit
+    deleted = []
+    for conv_id in (dirty_ids if dirty_ids is not None else list(convos.keys())):
+        session_data = convos.get(conv_id) or {}
+        history = session_data.get("history")
+
+        # If a chat becomes empty (or was removed), delete it from Firestore.
+        # Chats this session never loaded or wrote (e.g. a fresh empty chat) have no docs.
+        if not history:
+            if conv_id in saved:
+                writes.extend(_conversation_delete_writes(db, uid, conv_id))
+                deleted.append(conv_id)
+            continue
+
+        conv_ref = _conversation_ref(db, uid, conv_id)
+        conv_writes = []
+        saved_count, saved_digest = saved.get(conv_id, (0, None))
+        msgs_ref = conv_ref.collection("messages")
+
+        # 1. New messages only. Doc ids carry this session's writer id, so another
+        # tab appending to the same chat never overwrites them, and a retried save
+        # rewrites the same docs instead of duplicating them. 'seq' is a sort key
+        # taken from the save time: each save's messages stay together, after
+        # everything stored before them.
+        if saved_count > len(history):
+            # Fewer messages than this session stored: out of sync, so store the history afresh
+            print(f"Rewriting out-of-sync chat {conv_id}: {saved_count} stored, {len(history)} in session")
+            saved_count = 0
+            keep = {f"{writer}-{seq:06d}" for seq in range(len(history))}
+            conv_writes.extend(
+                (msg_ref, None) for msg_ref in msgs_ref.list_documents() if msg_ref.id not in keep
+            )
+        stamp = time.time_ns()
+        for seq in range(saved_count, len(history)):
+            role, msg = history[seq]
+            payload = json.dumps({'role': role, 'content': msg}).encode()
+            conv_writes.append((msgs_ref.document(f"{writer}-{seq:06d}"), {
+                'seq': stamp + seq,
+                'encrypted_data': cipher.encrypt(payload),
+            }))
+
+        # 2. Metadata, skipped if it did not change since the last write
+        meta = {k: v for k, v in session_data.items() if k != 'history'}
+        json_bytes = json.dumps(meta).encode()
+        digest = hashlib.blake2b(json_bytes, digest_size=16).digest()
+        doc_fields = {}
+        if saved_digest != digest:
+            # Encrypted metadata plus the plaintext creation time so the loader
+            # can sort server-side
+            doc_fields['encrypted_data'] = cipher.encrypt(json_bytes)
+            if session_data.get("created_at") is not None:
+                doc_fields['created_at'] = session_data["created_at"]
+        if conv_writes or doc_fields:
+            # Plaintext count lets the loader skip empty chats without decrypting
+            doc_fields['msg_count'] = len(history)
+            conv_writes.append((conv_ref, doc_fields))
+
+        if conv_writes:
+            writes.extend(conv_writes)
+            written[conv_id] = (len(history), digest)
+
+    if not writes:
+        return
+    writes.append((_conversations_version_ref(db, uid), {"conversations_version": firestore.Increment(1)}))
+    _commit_writes(db, writes)
+
+    saved.update(written)
+    for conv_id in deleted:
+        saved.pop(conv_id, None)
+
+def _drain_save_queue(uid: str):
     """
-    Deletes a specific conversation document from the user's 'conversations' subcollection in Firestore.
+    Executor task: performs the queued saves for 'uid' one after another.
     """
-    db = get_firestore_db()
-    if not db:
-        return
-    
-    try:
-        doc_ref = db.collection("users").document(uid).collection("conversations").document(chat_id)
-        doc_ref.delete()
-    except Exception as e:
-        st.error(f"Failed to delete conversation: {e}")
+    while True:
+        with _SAVE_QUEUES_LOCK:
+            pending = _SAVE_QUEUES[uid]
+            if pending.empty():
+                del _SAVE_QUEUES[uid]
+                return
+            convos, dirty_ids, save_state, on_error = pending.get_nowait()
+        try:
+            save_conversations_to_firestore(uid, convos, dirty_ids, save_state)
+        except Exception as e:
+            # No script run context on this thread, so st.error would be dropped
+            print(f"Background save failed for {uid}: {e}")
+            if on_error is not None:
+                on_error()
+
+def submit_save(uid: str, convos: Dict[str, Any], dirty_ids: Iterable[str] | None = None,
+                save_state: Dict[str, Any] | None = None, on_error: Callable[[], None] | None = None):
+    """
+    Queues 'save_conversations_to_firestore' on the background executor and returns immediately.
+    'convos' must be a snapshot the caller will not mutate afterwards; 'save_state' is the
+    session's own record (see 'new_save_state') and is updated once the write went through.
+    'on_error' is called (on the executor thread) if the save fails.
+    """
+    with _SAVE_QUEUES_LOCK:
+        pending = _SAVE_QUEUES.get(uid)
+        start_worker = pending is None
+        if start_worker:
+            pending = _SAVE_QUEUES[uid] = queue.Queue()
+        pending.put((convos, dirty_ids, save_state, on_error))
+    if start_worker:
+        _SAVE_EXECUTOR.submit(_drain_save_queue, uid)
+
+def wait_for_saves(uid: str, timeout: float = 5.0):
+    """
+    Blocks until the queued saves for 'uid' have been written, or 'timeout' seconds pass.
+    """
+    deadline = time.monotonic() + timeout
+    while uid in _SAVE_QUEUES and time.monotonic() < deadline:
+        time.sleep(0.05)
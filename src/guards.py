@@ -1,54 +1,60 @@
 import re
 from typing import List, Tuple
 
-BANNED = {"how to hack", "crack", "ddos", "payload", "exploit", "rat", "keylogger", "bypass paywall"}
+BANNED = frozenset({"how to hack", "crack", "ddos", "payload", "exploit", "rat", "keylogger", "bypass paywall"})
+
+# All banned keywords as one word-bounded alternation, so a message is scanned once.
+# Longest first, so a keyword is preferred over a shorter one it starts with.
+# Matched against the casefolded message.
+_BANNED_ESCAPED = tuple(re.escape(k) for k in sorted(BANNED, key=len, reverse=True))
+_BANNED_RE = re.compile(r"\b(?:" + "|".join(_BANNED_ESCAPED) + r")\b")
 
 # Whitelist split by categories for clarity/maintenance
 CYBER_TOPICS_CATEGORIES = {
-    "awareness": {
+    "awareness": frozenset({
         "phishing","phishing awareness","social media safety","digital footprint",
         "cyber hygiene","online privacy","identity theft","personal data protection",
         "safe browsing","fake websites","deepfake","ai scams","smishing","vishing",
         "privacy","breach","scam","malware","virus","ransomware",
         "update","patch","backup","encryption","social engineering",
         "email security","password manager","hacking prevention"
-    },
-    "auth_access": {
+    }),
+    "auth_access": frozenset({
         "password","passphrase","2fa","two-factor","multi-factor","mfa","otp","authenticator",
         "biometric authentication","passwordless login","single sign-on",
         "identity and access management","privileged access management","iam","pam",
         "account","login","sign-in"
-    },
-    "network_internet": {
+    }),
+    "network_internet": frozenset({
         "wifi","router","network","vpn","dns security","ip spoofing","man-in-the-middle attack",
         "ssl","tls","https","secure connection"
-    },
-    "endpoint_os": {
+    }),
+    "endpoint_os": frozenset({
         "patch management","device hardening","operating system security",
         "mobile security","byod security","endpoint protection","anti-malware","antivirus","zero trust"
-    },
-    "org_process": {
+    }),
+    "org_process": frozenset({
         "security policy","risk management","incident management plan",
         "business continuity","disaster recovery","incident response"
-    },
-    "cloud_api": {
+    }),
+    "cloud_api": frozenset({
         "cloud security","data residency","shared responsibility model","api security",
         "xdr","extended detection and response","edr","endpoint detection and response",
         "mxdr","managed xdr","soar","security orchestration automation and response"
-    },
-    "threats": {
+    }),
+    "threats": frozenset({
         "botnet","spyware","keylogger","trojan","adware","ddos","denial of service",
         "zero-day exploit","insider threat","threat detection","threat actor",
         "cyber attack","cyber threat"
-    },
-    "frameworks": {
+    }),
+    "frameworks": frozenset({
         "iso 27001","gdpr","pdpa","information security","cybersecurity","infosec"
-    },
-    "education": {
+    }),
+    "education": frozenset({
         "cyber ethics","digital citizenship","safe online behavior",
         "security training","cyberbullying prevention","security awareness"
-    },
-    "common_typos": {
+    }),
+    "common_typos": frozenset({
         # Phishing variations
         "phising", "pishing", "fishing", "phish",
         # Password variations
@@ -60,28 +66,38 @@ CYBER_TOPICS_CATEGORIES = {
         # General variations
         "wi-fi", "wi fi", "fire wall", "anti virus", "anti-virus",
         "authentification", "authenication", "priviledge", "hygene" 
-    }
+    })
 }
-# Flattened set used by the filter logic
-CYBER_TOPICS = set().union(*CYBER_TOPICS_CATEGORIES.values())
+# Flattened set used by the filter logic; computed once at import and immutable
+CYBER_TOPICS: frozenset[str] = frozenset().union(*CYBER_TOPICS_CATEGORIES.values())
+
+# Shorter messages cannot contain any topic, so the scan can be skipped
+_MIN_TOPIC_LEN = min(map(len, CYBER_TOPICS))
+
+_BANNED_MSG = ("I can't help with offensive or illegal hacking. "
+               "Let's focus on defensive skills like phishing detection, strong passwords, and 2FA.")
+
+_OFF_TOPIC_MSG = (
+    "This is a **Cybersecurity Education Bot**. Kindly ask questions related to cybersecurity.\n\n"
+    "**You can ask about:**\n"
+    "• Spotting phishing emails/messages\n"
+    "• Creating strong passwords & using password managers\n"
+    "• Two-factor authentication (2FA)\n"
+    "• Privacy settings for phone/social media\n"
+    "• Securing your home Wi-Fi/router\n"
+    "• Recognising scams, malware & safe downloading\n"
+    "• Updates, backups, and account recovery"
+)
 
 def guardrails_or_offtopic(user_text: str, history: List[Tuple[str, str]]) -> str | None:
-    q = user_text.lower()
-    if any(re.search(rf"\b{re.escape(k)}\b", q) for k in BANNED):
-        return ("I can't help with offensive or illegal hacking. "
-                "Let's focus on defensive skills like phishing detection, strong passwords, and 2FA.")
+    # Casefolded once, shared by both checks
+    q = user_text.casefold()
+    if _BANNED_RE.search(q):
+        return _BANNED_MSG
     if len(history) > 0:
         return None
-    if not any(k in q for k in CYBER_TOPICS):
-        return (
-            "This is a **Cybersecurity Education Bot**. Kindly ask questions related to cybersecurity.\n\n"
-            "**You can ask about:**\n"
-            "• Spotting phishing emails/messages\n"
-            "• Creating strong passwords & using password managers\n"
-            "• Two-factor authentication (2FA)\n"
-            "• Privacy settings for phone/social media\n"
-            "• Securing your home Wi-Fi/router\n"
-            "• Recognising scams, malware & safe downloading\n"
-            "• Updates, backups, and account recovery"
-        )
+    # Plain `in` checks: str.__contains__ runs in C and beats a regex alternation
+    # of the topics, which `re` tries one by one at every position
+    if len(q) < _MIN_TOPIC_LEN or not any(k in q for k in CYBER_TOPICS):
+        return _OFF_TOPIC_MSG
     return None
@@ -1,102 +1,179 @@
 import re
+import hashlib
+import threading
+from collections import OrderedDict, deque
+from itertools import islice
 import streamlit as st
-from src.session import save_convos
+from src.session import schedule_save, mark_dirty
 from typing import List, Tuple
 
-_STOPWORDS = {
+_STOPWORDS = frozenset({
     "what","how","why","is","are","the","a","an","of","in","to","for","on","with","and","or",
     "my","your","our","their","this","that","it","do","does","can","should","could","about",
     "please","tell","me","explain"
-}
+})
 
 OFFTOPIC_SUFFIX = " (Not Cybersecurity Related)"
 
+# First messages up to this length are used as the chat title as-is
+LOCAL_TITLE_MAX_LEN = 60
+
+_TITLE_CLEAN_RE = re.compile(r"[^\w\s-]")
+_TITLE_STRIP_RE = re.compile(r'["""\.\!\?\:]')
+
 def _clean_title(text: str) -> str:
-    text = re.sub(r"[^\w\s-]", "", text.lower())
+    text = _TITLE_CLEAN_RE.sub("", text.lower())
     words = [w for w in text.split() if w not in _STOPWORDS]
     return " ".join(words[:6]).title() or "Chat"
 
+# Names a chat has before it is titled: "New Chat", its uniquified "New Chat (2)"
+# form, and the older "Chat ..." placeholders. Names a user picked, such as
+# "New chatbot tips", must not match.
+_NEW_CHAT_NAME_RE = re.compile(r"new chat(?: \(\d+\))?", re.IGNORECASE)
+
+def _is_default_name(name: str) -> bool:
+    return bool(_NEW_CHAT_NAME_RE.fullmatch(name)) or name.startswith("Chat ")
+
 def _ensure_unique_name(name: str, convos: dict) -> str:
     existing = {v["name"] for v in convos.values()}
     if name not in existing:
         return name
-    n = 2
+    # Start past the suffixes already taken for this base name instead of probing from (2)
+    prefix = f"{name} ("
+    n = 2 + sum(1 for e in existing if e.startswith(prefix))
     while True:
         candidate = f"{name} ({n})"
         if candidate not in existing:
             return candidate
         n += 1
 
+# LLM titles by digest of the (model, first two user messages), shared across sessions.
+# Kept in memory only: titles are derived from user messages, which are stored encrypted.
+_TITLE_CACHE: "OrderedDict[str, str]" = OrderedDict()
+_TITLE_CACHE_SIZE = 512
+_TITLE_CACHE_LOCK = threading.Lock()
+
+def _title_cache_key(model: str, user_msgs: list[str]) -> str:
+    data = "\n".join([model, *user_msgs]).encode()
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def _cached_title(key: str) -> str | None:
+    with _TITLE_CACHE_LOCK:
+        title = _TITLE_CACHE.get(key)
+        if title is not None:
+            _TITLE_CACHE.move_to_end(key)
+        return title
+
+def _store_title(key: str, title: str):
+    with _TITLE_CACHE_LOCK:
+        _TITLE_CACHE[key] = title
+        _TITLE_CACHE.move_to_end(key)
+        if len(_TITLE_CACHE) > _TITLE_CACHE_SIZE:
+            _TITLE_CACHE.popitem(last=False)
+
 def set_title_from_msgs(client, model: str, convos: dict, session_id: str, user_msgs: list[str]):
     if not user_msgs:
         return
     sess = convos[session_id]
-    default_names = {"New Chat", "New chat"}
-    if not (sess["name"] in default_names or sess["name"].startswith("Chat ")):
+    if not _is_default_name(sess["name"]):
         return
 
     title = None
-    if client:
-        try:
-            prompt = (
-                "Create a concise 4–6 word title for this conversation topic. "
-                "No punctuation, quotes, emojis, or IDs. Return title only.\n\n"
-                f"User messages:\n- " + "\n- ".join(user_msgs[:2])
-            )
-            resp = client.models.generate_content(model=model, contents=prompt)
-            if resp and resp.text:
-                t = resp.text.strip().replace("\n", " ")
-                t = re.sub(r'["""\.\!\?\:]', "", t)
-                title = t
-        except Exception:
-            title = None
+    if len(user_msgs) == 1 and len(user_msgs[0]) <= LOCAL_TITLE_MAX_LEN:
+        # A short single message already makes a good title: skip the LLM round-trip
+        title = _TITLE_STRIP_RE.sub("", user_msgs[0].strip().replace("\n", " "))
+    elif client:
+        cache_key = _title_cache_key(model, user_msgs[:2])
+        title = _cached_title(cache_key)
+        if title is None:
+            try:
+                prompt = (
+                    "Create a concise 4–6 word title for this conversation topic. "
+                    "No punctuation, quotes, emojis, or IDs. Return title only.\n\n"
+                    f"User messages:\n- " + "\n- ".join(user_msgs[:2])
+                )
+                resp = client.models.generate_content(model=model, contents=prompt)
+                if resp and resp.text:
+                    t = resp.text.strip().replace("\n", " ")
+                    t = _TITLE_STRIP_RE.sub("", t)
+                    title = t
+                    _store_title(cache_key, title)
+            except Exception:
+                title = None
 
     if not title:
         title = _clean_title(" ".join(user_msgs[:2]))
 
     title = title[:40].strip()
     sess["name"] = _ensure_unique_name(title, convos)
-    save_convos()
+    mark_dirty(session_id)
+    schedule_save()
+
+def _first_n_user(hist, n: int) -> List[str]:
+    """First ``n`` user messages, without walking the rest of the history."""
+    return list(islice((m for (r, m) in hist if r == "user"), n))
+
+def _last_n_user(hist, n: int) -> List[str]:
+    """Last ``n`` user messages in chat order, scanning from the tail."""
+    return list(islice((m for (r, m) in reversed(hist) if r == "user"), n))[::-1]
 
 def auto_title_if_needed(client, model: str, convos: dict, session_id: str):
     sess = convos[session_id]
     name = sess["name"]
-    default_names = {"New Chat", "New chat"}
-    if not (name in default_names or name.startswith("Chat ")):
+    if not _is_default_name(name):
         return
-    user_msgs = [m for (r, m) in sess["history"] if r == "user"][:2]
+    user_msgs = _first_n_user(sess["history"], 2)
     if not user_msgs:
         return
     set_title_from_msgs(client, model, convos, session_id, user_msgs)
 
 def _maybe_update_title_after_first_turn(client, model: str):
     """De-duplicated helper to update the conversation title on the first/second user turn."""
-    u_turns = [m for (r, m) in st.session_state.convos[st.session_state.active_id]["history"] if r == "user"]
-    if len(u_turns) in (1, 2):
-        old_name = st.session_state.convos[st.session_state.active_id]["name"]
-        auto_title_if_needed(client, model, st.session_state.convos, st.session_state.active_id)
-        new_name = st.session_state.convos[st.session_state.active_id]["name"]
-        if old_name != new_name:
-            st.rerun()
+    ss = st.session_state
+    aid = ss.active_id
+    sess = ss.convos[aid]
+    # Only the first two turns matter; stop counting once a third user message is seen
+    if len(_first_n_user(sess["history"], 3)) not in (1, 2):
+        return
+    old_name = sess["name"]
+    auto_title_if_needed(client, model, ss.convos, aid)
+    if sess["name"] != old_name:
+        st.rerun()
 
 def mark_offtopic(client, model, convos: dict, session_id: str):
     sess = convos[session_id]
     name = sess["name"]
 
-    if name.lower().startswith("new chat") or name.startswith("Chat "):
-        user_msgs = [m for (r, m) in sess["history"] if r == "user"][-2:]
+    if _is_default_name(name):
+        user_msgs = _last_n_user(sess["history"], 2)
         if user_msgs:
             set_title_from_msgs(client, model, convos, session_id, user_msgs)
             name = sess["name"]
 
     if not name.endswith(OFFTOPIC_SUFFIX):
         sess["name"] = _ensure_unique_name(name + OFFTOPIC_SUFFIX, convos)
-        save_convos()
+        mark_dirty(session_id)
+        schedule_save()
+
+# Rough cap on the history sent with each prompt, so long chats keep a bounded prefill
+_HISTORY_TOKEN_BUDGET = 3000
+
+def _estimate_tokens(text: str) -> int:
+    # ~4 characters per token is close enough for budgeting English text
+    return len(text) // 4 + 1
+
+def build_prompt(user_msg: str, history: List[Tuple[str, str]]) -> str:
+    """Conversation part of the request, oldest first; the system instruction is sent separately."""
+    # Walk back from the newest turn until the token budget is spent
+    # Prepending keeps the result in chat order without a reversed copy
+    convo = deque()
+    budget = _HISTORY_TOKEN_BUDGET
+    for role, msg in reversed(history):
+        budget -= _estimate_tokens(msg)
+        if budget < 0:
+            break
+        convo.appendleft(("User: " if role == "user" else "Tutor: ") + msg)
 
-def build_prompt(system_instruction:str, user_msg: str, history: List[Tuple[str, str]]) -> str:
-    convo = [f"System: {system_instruction}"]
-    for role, msg in history[-8:]:
-        convo.append(("User: " if role == "user" else "Tutor: ") + msg)
     convo.append(f"User: {user_msg}")
     convo.append("Tutor:")
     return "\n".join(convo)
@@ -1,17 +1,41 @@
 import streamlit as st
 import requests
 import json
-import re 
 from src.firebase_auth import create_user_in_db
 from src.data_loader import load_user_data_from_firestore
 
 # --- Password Validation & Strength Logic ---
+def _char_classes(password: str) -> tuple[bool, bool, bool, bool]:
+    """
+    One pass over the password: (ASCII lowercase, ASCII uppercase, digit, symbol).
+    A symbol is anything that is neither a word character nor whitespace.
+    Stops as soon as all four classes have been seen.
+    """
+    lower = upper = digit = symbol = False
+    for c in password:
+        if "a" <= c <= "z":
+            lower = True
+        elif "A" <= c <= "Z":
+            upper = True
+        elif c.isdecimal():
+            digit = True
+        elif not (c.isalnum() or c == "_" or c.isspace()):
+            symbol = True
+        if lower and upper and digit and symbol:
+            break
+    return lower, upper, digit, symbol
+
 def get_password_strength(password: str) -> dict:
     """
     Analyzes password and returns a score (0-4), a color, and a feedback message.
     """
+    # Only say "Enter a password" if the input is truly empty
+    if len(password) == 0:
+        return {"score": 0, "color": "red", "msg": "Enter a password"}
+
     score = 0
     feedback = []
+    has_lower, has_upper, has_digit, has_symbol = _char_classes(password)
     
     # Check 1: Length
     if len(password) >= 8:
@@ -20,29 +44,25 @@ def get_password_strength(password: str) -> dict:
         feedback.append("At least 8 characters")
         
     # Check 2: Case
-    if re.search(r'[a-z]', password) and re.search(r'[A-Z]', password):
+    if has_lower and has_upper:
         score += 1
     else:
         feedback.append("Lower & Uppercase letters")
         
     # Check 3: Numbers
-    if re.search(r'\d', password):
+    if has_digit:
         score += 1
     else:
         feedback.append("At least one number")
         
     # Check 4: Symbols
-    if re.search(r'[^\w\s]', password):
+    if has_symbol:
         score += 1
     else:
         feedback.append("At least one symbol (!@#$...)")
-        
-    # Only say "Enter a password" if the input is truly empty
-    if len(password) == 0:
-        return {"score": 0, "color": "red", "msg": "Enter a password"}
-    
+
     # If score is low (even 0), show the feedback list
-    elif score < 3:
+    if score < 3:
         return {"score": score, "color": "red", "msg": "Weak: " + ", ".join(feedback)}
         
     elif score == 3:
@@ -2,7 +2,11 @@ import os
 import re
 import json
 import uuid
+import secrets
+import random
+import time
 import pathlib
+import threading
 from typing import List, Tuple, Dict, Any
 
 import streamlit as st
@@ -11,56 +15,165 @@ from dotenv import load_dotenv
 # --- Local Imports ---
 # Import the new Firebase functions from firebase_auth
 from src.firebase_auth import (
-    load_conversations_from_firestore, 
-    save_conversations_to_firestore,
+    load_conversations_cached,
+    new_save_state,
+    submit_save,
+    wait_for_saves,
     get_user_data
 )
 
 # ---------------- Session helpers ----------------
 def _new_session(name="New Chat"):
-    return {"name": name, "history": []}
+    return {"name": name, "history": [], "created_at": time.time()}
 
 def create_new_chat(convos: dict) -> str:
     """Creates a new chat, adds it to convos, and saves to Firestore if logged in."""
-    sid = str(uuid.uuid4())[:8]
+    sid = secrets.token_hex(4)
     convos[sid] = _new_session("New Chat")
-    save_convos()
+    schedule_save()
     return sid
 
+def mark_dirty(sid: str):
+    """Flags a conversation so the next save writes it to Firestore."""
+    st.session_state.setdefault("dirty_convos", set()).add(sid)
+
+def _logged_in_uid() -> str | None:
+    if st.session_state.get('logged_in') and st.session_state.get('user_info'):
+        return st.session_state.user_info.get("localId")
+    return None
+
+def _flush_dirty(uid: str, convos: dict, dirty: set, save_state: dict):
+    """
+    Snapshots the dirty chats and hands them to the background writer.
+    Only C-level copies are used, so this is safe to run off the script thread.
+    """
+    taken = set(dirty)
+    if not taken:
+        return
+    # Clear first: a change made while snapshotting re-marks its chat for the next flush,
+    # and a failed save marks its chats again so the next flush retries them
+    dirty.difference_update(taken)
+    snapshot = {}
+    for sid in taken:
+        sess = convos.get(sid)
+        if sess is not None:
+            snapshot[sid] = dict(sess, history=list(sess["history"]))
+    submit_save(uid, snapshot, taken, save_state, on_error=lambda: dirty.update(taken))
+
 def save_convos():
     """
-    Saves the current state of conversations to Firestore IF user is logged in.
+    Saves the conversations changed since the last save to Firestore IF user is logged in.
+    The write happens in the background; only a snapshot of the dirty chats is taken here.
     """
-    if st.session_state.get('logged_in') and st.session_state.get('user_info'):
-        uid = st.session_state.user_info.get("localId")
-        if uid:
-            save_conversations_to_firestore(uid, st.session_state.convos)
+    uid = _logged_in_uid()
+    if uid:
+        _flush_dirty(uid, st.session_state.convos, st.session_state.get("dirty_convos", set()),
+                     st.session_state.save_state)
+
+# Changes closer together than this are written to Firestore as one save
+SAVE_DEBOUNCE_SECONDS = 2.0
+
+class _DebouncedSaver:
+    """
+    Per-session timer that flushes the dirty chats once no new change arrived for
+    SAVE_DEBOUNCE_SECONDS. It keeps direct references to the session's convos, dirty
+    set and save state because the timer thread cannot reach st.session_state.
+    """
+
+    def __init__(self, uid: str, convos: dict, dirty: set, save_state: dict):
+        self.uid = uid
+        self.convos = convos
+        self.dirty = dirty
+        self.save_state = save_state
+        self.due_at = 0.0
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def schedule(self):
+        with self.lock:
+            self.due_at = time.monotonic() + SAVE_DEBOUNCE_SECONDS
+            if self.timer is None:
+                self._start_timer(SAVE_DEBOUNCE_SECONDS)
+
+    def cancel(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+    def _start_timer(self, delay: float):
+        self.timer = threading.Timer(delay, self._on_timer)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _on_timer(self):
+        with self.lock:
+            remaining = self.due_at - time.monotonic()
+            if remaining > 0:
+                # A newer change pushed the deadline back: wait out the rest
+                self._start_timer(remaining)
+                return
+            self.timer = None
+        _flush_dirty(self.uid, self.convos, self.dirty, self.save_state)
+
+def schedule_save():
+    """
+    Debounced 'save_convos': the dirty chats are written by a background timer
+    SAVE_DEBOUNCE_SECONDS after the last change, so a burst of messages costs one save.
+    """
+    uid = _logged_in_uid()
+    if not uid or not st.session_state.get("dirty_convos"):
+        return
+    convos, dirty = st.session_state.convos, st.session_state.dirty_convos
+    save_state = st.session_state.save_state
+    saver = st.session_state.get("_saver")
+    # Login/logout swap in new convos/dirty/save-state objects, so the saver is rebuilt with them
+    if (saver is None or saver.uid != uid or saver.convos is not convos
+            or saver.dirty is not dirty or saver.save_state is not save_state):
+        saver = st.session_state._saver = _DebouncedSaver(uid, convos, dirty, save_state)
+    saver.schedule()
+
+def flush_convos():
+    """
+    Writes pending (debounced) changes right away and waits for them to reach Firestore.
+    Called on sign-out, before the session's conversation state is dropped.
+    """
+    saver = st.session_state.get("_saver")
+    if saver is not None:
+        saver.cancel()
+    save_convos()
+    uid = _logged_in_uid()
+    if uid:
+        wait_for_saves(uid)
+
+# Session-state defaults; mutable values are given as factories so sessions never share them
+_DEFAULTS = (
+    ("convos", dict),
+    ("active_id", None),
+    ("renaming", False),
+    ("confirming_delete", False),
+    ("ui_theme", "dark"),
+    ("logged_in", False),
+    ("user_info", None),
+    ("password_question_count", 0),
+    ("phishing_question_count", 0),
+    ("in_password_game", False),
+    ("dirty_convos", set),
+    # What this session has stored in Firestore, see new_save_state
+    ("save_state", new_save_state),
+    # Per-session RNG for the game/quiz coin flips (no shared global random state)
+    ("rng", lambda: random.Random(uuid.uuid4().int)),
+)
 
 def ensure_session_state():
     """
     Initializes all core session state keys with default values.
     Actual data loading is deferred to 'load_user_data_from_firestore' after login.
     """
-    if "convos" not in st.session_state:
-        st.session_state.convos = {}
-    if "active_id" not in st.session_state:
-        st.session_state.active_id = None
-    if "renaming" not in st.session_state:
-        st.session_state.renaming = False
-    if "confirming_delete" not in st.session_state:
-        st.session_state.confirming_delete = False
-    if "ui_theme" not in st.session_state:
-        st.session_state.ui_theme = "dark"
-    if "logged_in" not in st.session_state:
-        st.session_state.logged_in = False
-    if "user_info" not in st.session_state:
-        st.session_state.user_info = None
-    if "password_question_count" not in st.session_state:
-        st.session_state.password_question_count = 0
-    if "phishing_question_count" not in st.session_state:
-        st.session_state.phishing_question_count = 0
-    if "in_password_game" not in st.session_state:
-        st.session_state.in_password_game = False
+    ss = st.session_state
+    for key, default in _DEFAULTS:
+        if key not in ss:
+            ss[key] = default() if callable(default) else default
 
     # Ensure a chat exists for UI when not logged in, or if logged in but no data loaded yet
     if not st.session_state.convos:
@@ -83,9 +196,12 @@ def load_user_data_from_firestore():
     if user_data:
         st.session_state.user_info.update(user_data) 
 
-    # 2. Load conversations
-    convos = load_conversations_from_firestore(uid)
+    # 2. Load conversations, after any save still queued from a previous session
+    wait_for_saves(uid)
+    convos, saved = load_conversations_cached(uid)
     st.session_state.convos = convos
+    st.session_state.dirty_convos = set()
+    st.session_state.save_state = new_save_state(saved)
     
     # 3. Set active chat
     if convos:
@@ -109,7 +225,8 @@ def active_history() -> List[Tuple[str, str]]:
 
 def set_active_history(h: List[Tuple[str, str]]):
     active_session()["history"] = h
-    save_convos()
+    mark_dirty(st.session_state.active_id)
+    schedule_save()
 
 def append_msg(role: str, msg: str):
     h = active_history()